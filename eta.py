@@ -9,11 +9,13 @@ __author__ = "Chun Law"
 __email__ = "chunlaw@rocketmail.com"
 __status__ = "production"
 
+import asyncio
 import requests
 import time
 from datetime import datetime, timezone
 import re
 import hashlib
+from functools import partial
 
 
 def get_platform_display(plat, lang):
@@ -46,51 +48,89 @@ class HKEta:
 
     # 0-indexed seq
     def getEtas(self, route_id, seq, language):
+        _etas = []
+        for method, url, kwargs, parse, lenient in self._eta_requests(route_id, seq, language):
+            try:
+                _etas.extend(parse(requests.request(method, url, **kwargs).json()))
+            except Exception:
+                if not lenient:
+                    raise
+        return _etas
+
+    # 0-indexed seq
+    async def getEtasAsync(self, session, route_id, seq, language):
+        results = await asyncio.gather(*(
+            self._fetch_async(session, *eta_request) for eta_request in self._eta_requests(route_id, seq, language)
+        ))
+        return [eta for etas in results for eta in etas]
+
+    @staticmethod
+    async def _fetch_async(session, method, url, kwargs, parse, lenient):
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                return parse(await response.json(content_type=None))
+        except Exception:
+            if not lenient:
+                raise
+            return []
+
+    def _eta_requests(self, route_id, seq, language):
         routeEntry = self.route_list[route_id]
         route, stops, bound = routeEntry['route'], routeEntry['stops'], routeEntry['bound']
         dest, service_type, co, nlb_id, gtfs_id = routeEntry['dest'], routeEntry['serviceType'], routeEntry['co'], \
         routeEntry["nlbId"], routeEntry['gtfsId']
-        _etas = []
         for company_id in co:
             if company_id == "kmb" and "kmb" in stops:
-                _etas.extend(self.kmb(
-                    route=route,
-                    stop_id=stops["kmb"][seq],
-                    bound=bound["kmb"],
-                    seq=seq, co=co,
-                    service_type=service_type
-                ))
+                yield "GET", "https://data.etabus.gov.hk/v1/transport/kmb/eta/{}/{}/{}".format(
+                    stops["kmb"][seq], route, service_type), {}, partial(
+                    self.kmb, route=route, bound=bound["kmb"], seq=seq, co=co, service_type=service_type
+                ), False
             elif company_id == "ctb" and "ctb" in stops:
-                _etas.extend(self.ctb(
-                    stop_id=stops['ctb'][seq], route=route, bound=bound['ctb'], seq=seq
-                ))
+                yield "GET", "https://rt.data.gov.hk/v2/transport/citybus/eta/CTB/{}/{}".format(
+                    stops['ctb'][seq], route), {}, partial(
+                    self.ctb, bound=bound['ctb'], seq=seq
+                ), False
             elif company_id == "nlb" and "nlb" in stops:
-                _etas.extend(self.nlb(
-                    stop_id=stops['nlb'][seq], nlb_id=nlb_id
-                ))
+                yield "POST", "https://rt.data.gov.hk/v1/transport/nlb/stop.php?action=estimatedArrivals", {
+                    "json": {
+                        "routeId": nlb_id,
+                        "stopId": stops['nlb'][seq],
+                        "language": "zh"
+                    },
+                    "headers": {
+                        "Content-Type": "text/plain"
+                    }
+                }, self.nlb, True
             elif company_id == "lrtfeeder" and "lrtfeeder" in stops:
-                _etas.extend(self.lrtfeeder(
-                    stop_id=stops['lrtfeeder'][seq], route=route, language=language
-                ))
+                yield "POST", "https://rt.data.gov.hk/v1/transport/mtr/bus/getSchedule", {
+                    "json": {
+                        "language": language,
+                        "routeName": route
+                    },
+                    "headers": {
+                        "Content-Type": "application/json"
+                    }
+                }, partial(
+                    self.lrtfeeder, stop_id=stops['lrtfeeder'][seq], language=language
+                ), False
             elif company_id == "mtr" and "mtr" in stops:
-                _etas.extend(self.mtr(
-                    stop_id=stops['mtr'][seq], route=route, bound=bound["mtr"]
-                ))
+                yield "GET", "https://rt.data.gov.hk/v1/transport/mtr/getSchedule.php?line={}&sta={}".format(
+                    route, stops['mtr'][seq]), {}, partial(
+                    self.mtr, stop_id=stops['mtr'][seq], route=route, bound=bound["mtr"]
+                ), False
             elif company_id == "lightRail" and "lightRail" in stops:
-                _etas.extend(self.lightrail(
-                    stop_id=stops['lightRail'][seq], route=route, dest=dest
-                ))
+                yield "GET", "https://rt.data.gov.hk/v1/transport/mtr/lrt/getSchedule?station_id={}".format(
+                    stops['lightRail'][seq][2:]), {}, partial(
+                    self.lightrail, route=route, dest=dest
+                ), False
             elif company_id == "gmb" and "gmb" in stops:
-                _etas.extend(self.gmb(
-                    stop_id=stops["gmb"][seq], gtfs_id=gtfs_id, seq=seq, bound=bound["gmb"]
-                ))
+                yield "GET", "https://data.etagmb.gov.hk/eta/route-stop/{}/{}".format(
+                    gtfs_id, stops["gmb"][seq]), {}, partial(
+                    self.gmb, seq=seq, bound=bound["gmb"]
+                ), False
 
-        return _etas
-
-    def kmb(self, stop_id, route, seq, service_type, co, bound):
-        data = requests.get(
-            "https://data.etabus.gov.hk/v1/transport/kmb/eta/{}/{}/{}".format(stop_id, route, service_type)).json()[
-            'data']
+    def kmb(self, res, route, seq, service_type, co, bound):
+        data = res['data']
         data = list(filter(lambda e: 'eta' in e and e['dir'] == bound, data))
         data.sort(key=lambda e: abs(seq - e['seq']))
         data = [e for e in data if e['seq'] == data[0]['seq']]
@@ -104,9 +144,8 @@ class HKEta:
             "co": "kmb"
         } for e in data]
 
-    def ctb(self, stop_id, route, bound, seq):
-        data = requests.get("https://rt.data.gov.hk/v2/transport/citybus/eta/CTB/{}/{}".format(stop_id, route)).json()[
-            'data']
+    def ctb(self, res, bound, seq):
+        data = res['data']
         data = list(filter(lambda e: 'eta' in e and e['dir'] in bound, data))
         data.sort(key=lambda e: abs(seq - e['seq']))
         data = [e for e in data if e['seq'] == data[0]['seq']]
@@ -119,34 +158,20 @@ class HKEta:
             "co": "ctb"
         } for e in data]
 
-    def nlb(self, stop_id, nlb_id):
-        try:
-            data = requests.post("https://rt.data.gov.hk/v1/transport/nlb/stop.php?action=estimatedArrivals", json={
-                "routeId": nlb_id,
-                "stopId": stop_id,
-                "language": "zh"
-            }, headers={
-                "Content-Type": "text/plain"
-            }).json()["estimatedArrivals"]
-            data = list(filter(lambda e: 'estimatedArrivalTime' in e, data))
-            return [{
-                "eta": e['estimatedArrivalTime'].replace(' ', 'T') + ".000+08:00",
-                "remark": {
-                    "zh": "",
-                    "en": ""
-                },
-                "co": "nlb"
-            } for e in data]
-        except Exception as e:
-            return []
+    def nlb(self, res):
+        data = res["estimatedArrivals"]
+        data = list(filter(lambda e: 'estimatedArrivalTime' in e, data))
+        return [{
+            "eta": e['estimatedArrivalTime'].replace(' ', 'T') + ".000+08:00",
+            "remark": {
+                "zh": "",
+                "en": ""
+            },
+            "co": "nlb"
+        } for e in data]
 
-    def lrtfeeder(self, stop_id, route, language):
-        data = requests.post("https://rt.data.gov.hk/v1/transport/mtr/bus/getSchedule", json={
-            "language": language,
-            "routeName": route
-        }, headers={
-            "Content-Type": "application/json"
-        }).json()['busStop']
+    def lrtfeeder(self, res, stop_id, language):
+        data = res['busStop']
         data = list(filter(lambda e: e["busStopId"] == stop_id, data))
         ret = []
         for buses in data:
@@ -169,9 +194,7 @@ class HKEta:
                 })
         return ret
 
-    def mtr(self, stop_id, route, bound):
-        res = requests.get(
-            "https://rt.data.gov.hk/v1/transport/mtr/getSchedule.php?line={}&sta={}".format(route, stop_id)).json()
+    def mtr(self, res, stop_id, route, bound):
         data, status = res["data"], res["status"]
 
         if status == 0:
@@ -188,10 +211,8 @@ class HKEta:
             })
         return ret
 
-    def lightrail(self, stop_id, route, dest):
-        platform_list = requests.get(
-            "https://rt.data.gov.hk/v1/transport/mtr/lrt/getSchedule?station_id={}".format(stop_id[2:])).json()[
-            "platform_list"]
+    def lightrail(self, res, route, dest):
+        platform_list = res["platform_list"]
         ret = []
         for platform in platform_list:
             route_list, platform_id = platform["route_list"], platform["platform_id"]
@@ -218,8 +239,8 @@ class HKEta:
                     pass
         return ret
 
-    def gmb(self, gtfs_id, stop_id, bound, seq):
-        data = requests.get("https://data.etagmb.gov.hk/eta/route-stop/{}/{}".format(gtfs_id, stop_id)).json()["data"]
+    def gmb(self, res, bound, seq):
+        data = res["data"]
         data = list(
             filter(lambda e: (e['route_seq'] == 1 and bound == "O") or (e['route_seq'] == 2 and bound == "I"), data))
         data = list(filter(lambda e: e["stop_seq"] == seq + 1, data))
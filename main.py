@@ -1,23 +1,82 @@
+import asyncio
 import json
 import math
 import os
+import queue
 import random
+import re
+import signal
+import sys
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
+import time
+from datetime import datetime, timedelta, timezone as fixed_timezone
+from itertools import accumulate
 from json import JSONDecodeError
+import aiohttp
+import numpy as np
 from pytz import timezone
 
 from eta import HKEta
 
+try:
+    import orjson
+
+    _loads = orjson.loads
+    _dumps = orjson.dumps
+except ImportError:
+    _loads = json.loads
+
+    def _dumps(obj):
+        return json.dumps(obj).encode()
+
+
 MIN_SEGMENT_SECONDS = 5
 MAX_SEGMENT_SECONDS = 3600
+FLUSH_INTERVAL_SECONDS = 60
+HK_TZ = timezone('Asia/Hong_Kong')
+NUM_TASKS = 32
+_CO_DISPLAY = {"lightrail": "LRT", "lrtfeeder": "MTR-BUS"}
+_HAS_DIGIT = re.compile(r"\d").search
 
 hketa = HKEta()
 routes = list(hketa.route_list.items())
-file_lock = threading.Lock()
+_path_locks = {}
+_locks_guard = threading.Lock()
+_file_cache = {}
+_file_dirty = set()
+_file_generation = {}
+_lat_rad = {}
+_lon_rad = {}
+_cos_lat = {}
+_segment_distances = {}
+_known_dirs = set()
+_route_flags = {}
+_segments = []
+_segment_cum_weights = {}
+_log_queue = queue.SimpleQueue()
 
 previous_gmb_query = 0
+_tz_cache = {}
+_clock = threading.local()
+
+
+def _write_log():
+    while True:
+        chunks = [_log_queue.get()]
+        while not _log_queue.empty():
+            chunks.append(_log_queue.get_nowait())
+        stop = None in chunks
+        sys.stdout.write("".join(chunk for chunk in chunks if chunk is not None))
+        sys.stdout.flush()
+        if stop:
+            return
+
+
+def log(text):
+    _log_queue.put(text)
+
+
+_log_thread = threading.Thread(target=_write_log, daemon=True)
 
 
 def min_diff_cal(first, last, default):
@@ -42,7 +101,50 @@ def max_diff_cal(first, last, default):
         return min(default, first * 1.25)
 
 
+def _fixed_offset(minutes):
+    tz = _tz_cache.get(minutes)
+    if tz is None:
+        tz = fixed_timezone(timedelta(minutes=minutes))
+        _tz_cache[minutes] = tz
+    return tz
+
+
+def _parse_fixed_iso_datetime(datetime_str):
+    # Fast path for the fixed "YYYY-MM-DDTHH:MM:SS[.fff](Z|+HH:MM|+HHMM)" layout returned by the ETA APIs
+    if datetime_str[-1] == 'Z':
+        body = datetime_str[:-1]
+        offset = 0
+    else:
+        if datetime_str[-3] == ':':
+            body, sign, offset_hours, offset_minutes = datetime_str[:-6], datetime_str[-6], datetime_str[-5:-3], datetime_str[-2:]
+        else:
+            body, sign, offset_hours, offset_minutes = datetime_str[:-5], datetime_str[-5], datetime_str[-4:-2], datetime_str[-2:]
+        offset = int(offset_hours) * 60 + int(offset_minutes)
+        if sign == '-':
+            offset = -offset
+        elif sign != '+':
+            raise ValueError(f"invalid utc offset in '{datetime_str}'")
+    if len(body) < 19 or body[4] != '-' or body[7] != '-' or body[10] != 'T' or body[13] != ':' or body[16] != ':':
+        raise ValueError(f"invalid datetime layout in '{datetime_str}'")
+    microsecond = 0
+    if len(body) > 19:
+        if body[19] != '.':
+            raise ValueError(f"invalid fraction in '{datetime_str}'")
+        microsecond = int(body[20:26].ljust(6, '0'))
+    return datetime(int(body[0:4]), int(body[5:7]), int(body[8:10]), int(body[11:13]), int(body[14:16]), int(body[17:19]), microsecond, _fixed_offset(offset))
+
+
+try:
+    from ciso8601 import parse_datetime as _parse_iso_datetime
+except ImportError:
+    _parse_iso_datetime = _parse_fixed_iso_datetime
+
+
 def parse_datetime(datetime_str):
+    try:
+        return _parse_iso_datetime(datetime_str)
+    except (ValueError, IndexError):
+        pass
     formats = ["%Y-%m-%dT%H:%M:%S.%f%z", "%Y-%m-%dT%H:%M:%S%z"]
     for fmt in formats:
         try:
@@ -55,24 +157,26 @@ def parse_datetime(datetime_str):
     raise ValueError(f"time data '{datetime_str}' does not match any supported format")
 
 
-def find_first_bus_best_match(hketa, route_id, stop_index, prev_target_time):
-    etas_next = hketa.getEtas(route_id=route_id, seq=stop_index + 1, language="en")
-    if not etas_next or len(etas_next) <= 0 or 'eta' not in etas_next[0] or etas_next[0]['eta'] is None or (len(etas_next) > 1 and 'eta' in etas_next[1] and etas_next[1]['eta'] is not None):
-        return None, None
+def _prep_etas(etas, anchor_time):
+    segments = []
+    for eta in etas:
+        if 'eta' not in eta or eta['eta'] is None:
+            continue
+        current_eta_time = parse_datetime(eta['eta'])
+        segments.append((current_eta_time, (current_eta_time - anchor_time).total_seconds()))
+    return segments
 
-    etas_one_after = hketa.getEtas(route_id=route_id, seq=stop_index + 2, language="en")
-    if etas_one_after and len(etas_one_after) > 0 and 'eta' in etas_one_after[0] and etas_one_after[0]['eta'] is not None:
-        return None, None
 
-    eta = etas_next[0]
-    if 'eta' not in eta or eta['eta'] is None:
+def find_first_bus_best_match(get_etas, stop_index, next_segments):
+    etas_next = get_etas(stop_index + 1)
+    if not etas_next or len(etas_next) <= 0 or 'eta' not in etas_next[0] or etas_next[0]['eta'] is None or (len(etas_next) > 1 and 'eta' in etas_next[1] and etas_next[1]['eta'] is not None):
         return None, None
 
-    current_eta_time = parse_datetime(eta['eta'])
-    if current_eta_time < prev_target_time:
+    etas_one_after = get_etas(stop_index + 2)
+    if etas_one_after and len(etas_one_after) > 0 and 'eta' in etas_one_after[0] and etas_one_after[0]['eta'] is not None:
         return None, None
 
-    segment_seconds = (current_eta_time - prev_target_time).total_seconds()
+    current_eta_time, segment_seconds = next_segments[0]
 
     if MIN_SEGMENT_SECONDS <= segment_seconds <= MAX_SEGMENT_SECONDS:
         return current_eta_time, segment_seconds
@@ -80,46 +184,28 @@ def find_first_bus_best_match(hketa, route_id, stop_index, prev_target_time):
     return None, None
 
 
-def find_last_bus_best_match(hketa, route_id, stop_index, prev_target_time):
-    etas_this = hketa.getEtas(route_id=route_id, seq=stop_index, language="en")
+def find_last_bus_best_match(get_etas, stop_index, next_segments):
+    etas_this = get_etas(stop_index)
     if not etas_this or len(etas_this) <= 0 or 'eta' not in etas_this[0] or etas_this[0]['eta'] is None or (len(etas_this) > 1 and 'eta' in etas_this[1] and etas_this[1]['eta'] is not None):
         return None, None
 
-    etas_next = hketa.getEtas(route_id=route_id, seq=stop_index + 1, language="en")
-    if not etas_next:
+    if not next_segments:
         return None, None
 
-    etas_previous = hketa.getEtas(route_id=route_id, seq=stop_index - 1, language="en")
+    etas_previous = get_etas(stop_index - 1)
     if etas_previous and len(etas_previous) > 0 and 'eta' in etas_previous[0] and etas_previous[0]['eta'] is not None:
         return None, None
 
-    best_match_eta_time = None
-    smallest_diff = float('inf')
-
-    for eta in etas_next:
-        if 'eta' not in eta or eta['eta'] is None:
-            continue
-
-        current_eta_time = parse_datetime(eta['eta'])
-        if current_eta_time < prev_target_time:
-            continue
-
-        segment_seconds = (current_eta_time - prev_target_time).total_seconds()
-
+    # Segments are in ascending ETA order, so the first one in range is the smallest
+    for current_eta_time, segment_seconds in next_segments:
         if MIN_SEGMENT_SECONDS <= segment_seconds <= MAX_SEGMENT_SECONDS:
-            if segment_seconds < smallest_diff:
-                smallest_diff = segment_seconds
-                best_match_eta_time = current_eta_time
-
-    if best_match_eta_time:
-        return best_match_eta_time, smallest_diff
+            return current_eta_time, segment_seconds
 
     return None, None
 
 
-def find_best_match(hketa, route_id, stop_index, prev_target_time, prefix, stop_id1, stop_id2):
-    etas_next = hketa.getEtas(route_id=route_id, seq=stop_index + 1, language="en")
-    if not etas_next:
+def find_best_match(next_segments, prefix, stop_id1, stop_id2):
+    if not next_segments:
         return None, None
 
     first_bus_diff = read_file(f"first_bus_times/{prefix}.json", stop_id1, stop_id2)
@@ -128,264 +214,347 @@ def find_best_match(hketa, route_id, stop_index, prev_target_time, prefix, stop_
     min_diff = min_diff_cal(first_bus_diff, last_bus_diff, MIN_SEGMENT_SECONDS)
     max_diff = max_diff_cal(first_bus_diff, last_bus_diff, MAX_SEGMENT_SECONDS)
 
-    best_match_eta_time = None
-    smallest_diff = float('inf')
+    # Segments are in ascending ETA order, so the first one in range is the smallest
+    for current_eta_time, segment_seconds in next_segments:
+        if min_diff <= segment_seconds <= max_diff:
+            return current_eta_time, segment_seconds
 
-    for eta in etas_next:
-        if 'eta' not in eta or eta['eta'] is None:
-            continue
+    return None, None
 
-        current_eta_time = parse_datetime(eta['eta'])
-        if current_eta_time < prev_target_time:
+
+def _index_stop_locations():
+    for stop_id, stop in hketa.stop_list.items():
+        location = stop.get("location")
+        if not location:
             continue
+        lat_rad = math.radians(location["lat"])
+        _lat_rad[stop_id] = lat_rad
+        _lon_rad[stop_id] = math.radians(location["lng"])
+        _cos_lat[stop_id] = math.cos(lat_rad)
 
-        segment_seconds = (current_eta_time - prev_target_time).total_seconds()
 
-        if min_diff <= segment_seconds <= max_diff:
-            if segment_seconds < smallest_diff:
-                smallest_diff = segment_seconds
-                best_match_eta_time = current_eta_time
+def haversine_np(lat1_rad, lon1_rad, lat2_rad, lon2_rad, cos_lat1, cos_lat2):
+    dlat = lat2_rad - lat1_rad
+    dlon = lon2_rad - lon1_rad
+    a = np.sin(dlat / 2) ** 2 + cos_lat1 * cos_lat2 * np.sin(dlon / 2) ** 2
+    return 6371.0 * 2 * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+
+def _index_segment_distances():
+    pairs = set()
+    for route in hketa.route_list.values():
+        for stop_ids in route.get("stops", {}).values():
+            for stop_id1, stop_id2 in zip(stop_ids, stop_ids[1:]):
+                if stop_id1 in _lat_rad and stop_id2 in _lat_rad:
+                    pairs.add((stop_id1, stop_id2))
+    if not pairs:
+        return
+    pairs = list(pairs)
+    distances = haversine_np(
+        np.array([_lat_rad[stop_id1] for stop_id1, _ in pairs]),
+        np.array([_lon_rad[stop_id1] for stop_id1, _ in pairs]),
+        np.array([_lat_rad[stop_id2] for _, stop_id2 in pairs]),
+        np.array([_lon_rad[stop_id2] for _, stop_id2 in pairs]),
+        np.array([_cos_lat[stop_id1] for stop_id1, _ in pairs]),
+        np.array([_cos_lat[stop_id2] for _, stop_id2 in pairs])
+    )
+    _segment_distances.update(zip(pairs, distances.tolist()))
 
-    if best_match_eta_time:
-        return best_match_eta_time, smallest_diff
 
-    return None, None
+_index_stop_locations()
+_index_segment_distances()
 
 
-def haversine(lat1, lon1, lat2, lon2):
-    lat1_rad = math.radians(lat1)
-    lon1_rad = math.radians(lon1)
-    lat2_rad = math.radians(lat2)
-    lon2_rad = math.radians(lon2)
-    dlat = lat2_rad - lat1_rad
-    dlon = lon2_rad - lon1_rad
-    a = math.sin(dlat / 2) ** 2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(dlon / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    return 6371.0 * c
+def _now_fields():
+    now_epoch = int(time.time())
+    if getattr(_clock, "second", None) != now_epoch:
+        now_time = datetime.fromtimestamp(now_epoch, HK_TZ)
+        now_date = now_time.strftime('%Y%m%d')
+        _clock.hour = now_time.strftime('%H')
+        _clock.weekday = '0' if now_date in hketa.holidays else now_time.strftime('%w')
+        _clock.second = now_epoch
+    return _clock
 
 
 def current_hour():
-    now_time = datetime.now(timezone('Asia/Hong_Kong'))
-    return now_time.strftime('%H')
+    return _now_fields().hour
 
 
 def current_weekday():
-    now_time = datetime.now(timezone('Asia/Hong_Kong'))
-    now_date = now_time.strftime('%Y%m%d')
-    if now_date in hketa.holidays:
-        return '0'
-    return now_time.strftime('%w')
+    return _now_fields().weekday
 
 
 def ensure_directory(dir_name):
-    if not os.path.exists(dir_name):
-        os.makedirs(dir_name, exist_ok=True)
-
-def read_file(file_path, stop_id1, stop_id2):
-    with file_lock:
-        dir_name = os.path.dirname(file_path)
-        ensure_directory(dir_name)
-        if not os.path.exists(dir_name):
-            return None
+    if dir_name in _known_dirs:
+        return
+    os.makedirs(dir_name, exist_ok=True)
+    _known_dirs.add(dir_name)
+
+def _lock_for(file_path):
+    lock = _path_locks.get(file_path)
+    if lock is None:
+        with _locks_guard:
+            lock = _path_locks.get(file_path)
+            if lock is None:
+                lock = threading.Lock()
+                _path_locks[file_path] = lock
+    return lock
+
+
+def _load_file(file_path):
+    data = _file_cache.get(file_path)
+    if data is None:
+        data = {}
         try:
-            with open(file_path, 'r') as file:
-                data = json.load(file)
-                if stop_id1 in data:
-                    times = data[stop_id1]
-                    if stop_id2 in times:
-                        return times[stop_id2]
-                    else:
-                        return None
-                else:
-                    return None
+            with open(file_path, 'rb') as file:
+                data = _loads(file.read())
         except FileNotFoundError:
             pass
         except JSONDecodeError:
             pass
         except Exception as e:
-            print(f"Error while reading {file_path}: {e}")
+            log(f"Error while reading {file_path}: {e}\n")
+        _file_cache[file_path] = data
+    return data
+
+
+def _snapshot_file(file_path):
+    # Called with the file lock held; the copy can then be serialized without it
+    _file_dirty.discard(file_path)
+    generation = _file_generation.get(file_path, 0) + 1
+    _file_generation[file_path] = generation
+    return generation, {stop_id1: dict(times) for stop_id1, times in _file_cache[file_path].items()}
+
+
+def _write_snapshot(file_path, generation, snapshot):
+    temp_path = f"{file_path}.{generation}.tmp"
+    try:
+        with open(temp_path, 'wb') as file:
+            file.write(_dumps(snapshot))
+        with _lock_for(file_path):
+            if generation == _file_generation[file_path]:
+                os.replace(temp_path, file_path)
+    except Exception:
+        with _lock_for(file_path):
+            # Unless a newer snapshot has taken over, this data is still unsaved
+            if generation == _file_generation[file_path]:
+                _file_dirty.add(file_path)
+        raise
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def flush_files():
+    for file_path in list(_file_dirty):
+        with _lock_for(file_path):
+            if file_path not in _file_dirty:
+                continue
+            generation, snapshot = _snapshot_file(file_path)
+        try:
+            _write_snapshot(file_path, generation, snapshot)
+        except Exception as e:
+            log(f"Error while writing {file_path}: {e}\n")
+    _evict_stale_files()
+
+
+def _evict_stale_files():
+    # Hourly files of other hours are only written again once a week, so reload them from disk when needed
+    current_prefix = f"times_hourly/{current_weekday()}/{current_hour()}/"
+    for file_path in list(_file_cache):
+        if not file_path.startswith("times_hourly/") or file_path.startswith(current_prefix):
+            continue
+        with _lock_for(file_path):
+            if file_path not in _file_dirty:
+                _file_cache.pop(file_path, None)
+
+
+def read_file(file_path, stop_id1, stop_id2):
+    with _lock_for(file_path):
+        dir_name = os.path.dirname(file_path)
+        ensure_directory(dir_name)
+        data = _load_file(file_path)
+        if stop_id1 in data:
+            times = data[stop_id1]
+            if stop_id2 in times:
+                return times[stop_id2]
         return None
 
 
 def write_file(file_path, stop_id1, stop_id2, diff, distance):
-    with file_lock:
+    with _lock_for(file_path):
         dir_name = os.path.dirname(file_path)
         ensure_directory(dir_name)
-        data = {stop_id1: {stop_id2: diff}}
-        try:
-            with open(file_path, 'r') as file:
-                data = json.load(file)
-                if stop_id1 in data:
-                    times = data[stop_id1]
-                    if stop_id2 in times:
-                        time = times[stop_id2]
-                        if time < 0 or (distance > 1.5 and time < min(2.0, diff)):
-                            times[stop_id2] = diff
-                        else:
-                            diff = (time * 9 + diff) / 10
-                            times[stop_id2] = diff
-                    else:
-                        times[stop_id2] = diff
+        data = _load_file(file_path)
+        if stop_id1 in data:
+            times = data[stop_id1]
+            if stop_id2 in times:
+                previous = times[stop_id2]
+                if previous < 0 or (distance > 1.5 and previous < min(2.0, diff)):
+                    times[stop_id2] = diff
                 else:
-                    data[stop_id1] = {stop_id2: diff}
-        except FileNotFoundError:
-            pass
-        except JSONDecodeError:
-            pass
-        except Exception as e:
-            print(f"Error while reading {file_path}: {e}")
-        with open(file_path, 'w') as file:
-            json.dump(data, file)
+                    diff = (previous * 9 + diff) / 10
+                    times[stop_id2] = diff
+            else:
+                times[stop_id2] = diff
+        else:
+            data[stop_id1] = {stop_id2: diff}
+        _file_dirty.add(file_path)
 
 
 def has_numbers(input_string):
-    return any(char.isdigit() for char in input_string)
+    return _HAS_DIGIT(input_string) is not None
+
+
+def _index_routes():
+    for key, route in routes:
+        route_number = route["route"]
+        is_night = route_number.startswith("N") or route_number.endswith("S")
+        _route_flags[key] = (has_numbers(route_number), is_night, "gmb" in route["co"])
+        for co, stop_ids in route.get("stops", {}).items():
+            for stop_index in range(len(stop_ids) - 1):
+                stop_id1 = stop_ids[stop_index]
+                _segments.append((key, route, co, stop_index, stop_id1, stop_ids[stop_index + 1], stop_id1[0:2]))
+
+
+def route_chance(key, night):
+    has_digit, is_night, _ = _route_flags[key]
+    if has_digit and night and not is_night:
+        return 0.01
+    return 1
+
+
+def _acceptance_weight(chance):
+    # A roll used to be accepted when random.uniform(0, 1) >= chance
+    return 1 if chance >= 1 else 1 - chance
 
 
-def roll_chance(route, info):
+def _index_segment_weights():
+    for night in (False, True):
+        weights = (_acceptance_weight(route_chance(segment[0], night)) for segment in _segments)
+        _segment_cum_weights[night] = list(accumulate(weights))
+
+
+def pick_segment():
     global previous_gmb_query
-    route_number = route["route"]
-    hour = int(current_hour())
-    if not any(char.isdigit() for char in route_number):
-        return True
-    chance = 1
-    if 2 <= hour < 5:
-        if not (route_number.startswith("N") or route_number.endswith("S")):
-            chance = 0.01
-    if "gmb" in route["co"]:
-        now = round(datetime.now(timezone('Asia/Hong_Kong')).timestamp())
-        if now - previous_gmb_query < 5:
-            chance = 0
-        else:
+    night = 2 <= int(current_hour()) < 5
+    cum_weights = _segment_cum_weights[night]
+    while True:
+        segment = random.choices(_segments, cum_weights=cum_weights)[0]
+        key = segment[0]
+        has_digit, _, is_gmb = _route_flags[key]
+        if has_digit and is_gmb:
+            now = round(time.time())
+            if now - previous_gmb_query < 5:
+                continue
             previous_gmb_query = now
-    info[0] = chance
-    return chance > 0 and (chance >= 1 or random.uniform(0, 1) >= chance)
+        return segment, route_chance(key, night)
 
 
-def run():
-    key, route = random.choice(routes)
-    info = [1]
-    while not roll_chance(route, info):
-        key, route = random.choice(routes)
-    if "stops" not in route:
-        return
-    stops = route["stops"]
-    if len(stops) == 0:
-        return
-    co, stop_ids = random.choice(list(stops.items()))
-    if len(stop_ids) < 2:
-        return
-    stop_index = random.randint(0, len(stop_ids) - 2)
+_index_routes()
+_index_segment_weights()
 
-    stop_id1 = stop_ids[stop_index]
-    stop_id2 = stop_ids[stop_index + 1]
 
-    prefix = stop_id1[0:2]
+async def run(session):
+    segment, chance = pick_segment()
+    key, route, co, stop_index, stop_id1, stop_id2, prefix = segment
 
+    stop_count = len(route["stops"][co])
+    seqs = tuple(seq for seq in (stop_index, stop_index + 1, stop_index + 2, stop_index - 1) if 0 <= seq < stop_count)
+    results = await asyncio.gather(
+        *(hketa.getEtasAsync(session, route_id=key, seq=seq, language="en") for seq in seqs),
+        return_exceptions=True
+    )
+    etas_cache = dict(zip(seqs, results))
+
+    def get_etas(seq):
+        etas = etas_cache.get(seq, [])
+        if isinstance(etas, Exception):
+            raise etas
+        return etas
+
+    lines = []
     try:
-        initial_etas = hketa.getEtas(route_id=key, seq=stop_index, language="en")
+        initial_etas = get_etas(stop_index)
         if not initial_etas or not initial_etas[0].get('eta'):
             return
 
         anchor_time = parse_datetime(initial_etas[0]['eta'])
+        distance = _segment_distances[(stop_id1, stop_id2)]
+        hour = current_hour()
+        weekday = current_weekday()
+        next_segments = _prep_etas(get_etas(stop_index + 1), anchor_time)
+        # Routes run by several operators list each operator's ETAs in turn, so order them explicitly
+        sorted_segments = sorted(next_segments)
+
+        route_number = route["route"]
+        co_display = _CO_DISPLAY.get(co.casefold(), co.upper())
+        is_light_rail = "lightRail" in route["co"]
+
+        def log_and_write(tag, file_paths, diff):
+            if is_light_rail:
+                diff = max(120.0, diff)
+            for file_path in file_paths:
+                write_file(file_path, stop_id1, stop_id2, diff, distance)
+            lines.append(f"[{tag}] WD{weekday} H{hour}: {co_display:<7} {route_number:<4} [{chance:.2f}] {stop_id1:<16} > {stop_id2:<16} {f'{distance:.2f}':>5}km {f'{(diff / 60):.2f}':>5}mins\n")
 
-        _, first_bus_diff = find_first_bus_best_match(hketa, key, stop_index, anchor_time)
-        if first_bus_diff is not None:
-            pos1 = hketa.stop_list[stop_id1]["location"]
-            pos2 = hketa.stop_list[stop_id2]["location"]
-            distance = haversine(pos1["lat"], pos1["lng"], pos2["lat"], pos2["lng"])
-
-            if "lightRail" in route["co"]:
-                first_bus_diff = max(120.0, first_bus_diff)
-
-            hour = current_hour()
-            weekday = current_weekday()
-            write_file(f"first_bus_times/{prefix}.json", stop_id1, stop_id2, first_bus_diff, distance)
-
-            route_number = route["route"]
-            chance = info[0]
-            co_display = co.upper()
-            if co.casefold() == "lightrail".casefold():
-                co_display = "LRT"
-            elif co.casefold() == "lrtfeeder".casefold():
-                co_display = "MTR-BUS"
-            print(f"[F] WD{weekday} H{hour}: {co_display:<7} {route_number:<4} [{chance:.2f}] {stop_id1:<16} > {stop_id2:<16} {f'{distance:.2f}':>5}km {f'{(first_bus_diff / 60):.2f}':>5}mins")
-
-        _, last_bus_diff = find_last_bus_best_match(hketa, key, stop_index, anchor_time)
-        if last_bus_diff is not None:
-            pos1 = hketa.stop_list[stop_id1]["location"]
-            pos2 = hketa.stop_list[stop_id2]["location"]
-            distance = haversine(pos1["lat"], pos1["lng"], pos2["lat"], pos2["lng"])
-
-            if "lightRail" in route["co"]:
-                last_bus_diff = max(120.0, last_bus_diff)
-
-            hour = current_hour()
-            weekday = current_weekday()
-            write_file(f"last_bus_times/{prefix}.json", stop_id1, stop_id2, last_bus_diff, distance)
-
-            route_number = route["route"]
-            chance = info[0]
-            co_display = co.upper()
-            if co.casefold() == "lightrail".casefold():
-                co_display = "LRT"
-            elif co.casefold() == "lrtfeeder".casefold():
-                co_display = "MTR-BUS"
-            print(f"[L] WD{weekday} H{hour}: {co_display:<7} {route_number:<4} [{chance:.2f}] {stop_id1:<16} > {stop_id2:<16} {f'{distance:.2f}':>5}km {f'{(last_bus_diff / 60):.2f}':>5}mins")
+        # A first bus is only recognised when there is a stop after the next one to check
+        if stop_index + 2 < stop_count:
+            _, first_bus_diff = find_first_bus_best_match(get_etas, stop_index, next_segments)
+            if first_bus_diff is not None:
+                log_and_write("F", (f"first_bus_times/{prefix}.json",), first_bus_diff)
 
+        _, last_bus_diff = find_last_bus_best_match(get_etas, stop_index, sorted_segments)
+        if last_bus_diff is not None:
+            log_and_write("L", (f"last_bus_times/{prefix}.json",), last_bus_diff)
 
-        _, diff = find_best_match(hketa, key, stop_index, anchor_time, prefix, stop_id1, stop_id2)
+        _, diff = find_best_match(sorted_segments, prefix, stop_id1, stop_id2)
         if diff is not None:
-            pos1 = hketa.stop_list[stop_id1]["location"]
-            pos2 = hketa.stop_list[stop_id2]["location"]
-            distance = haversine(pos1["lat"], pos1["lng"], pos2["lat"], pos2["lng"])
-
-            if "lightRail" in route["co"]:
-                diff = max(120.0, diff)
-
-            hour = current_hour()
-            weekday = current_weekday()
-            write_file(f"times/{prefix}.json", stop_id1, stop_id2, diff, distance)
-            write_file(f"times_hourly/{weekday}/{hour}/{prefix}.json", stop_id1, stop_id2, diff, distance)
-
-            route_number = route["route"]
-            chance = info[0]
-            co_display = co.upper()
-            if co.casefold() == "lightrail".casefold():
-                co_display = "LRT"
-            elif co.casefold() == "lrtfeeder".casefold():
-                co_display = "MTR-BUS"
-            print(f"[R] WD{weekday} H{hour}: {co_display:<7} {route_number:<4} [{chance:.2f}] {stop_id1:<16} > {stop_id2:<16} {f'{distance:.2f}':>5}km {f'{(diff / 60):.2f}':>5}mins")
+            log_and_write("R", (f"times/{prefix}.json", f"times_hourly/{weekday}/{hour}/{prefix}.json"), diff)
     except Exception as e:
-        print(f"Error while running for eta from {stop_id1} to {stop_id2} ({co}): {e}")
+        lines.append(f"Error while running for eta from {stop_id1} to {stop_id2} ({co}): {e}\n")
+    finally:
+        if lines:
+            log("".join(lines))
 
-def run_repeatedly():
+
+async def run_repeatedly(session):
     while True:
         try:
-            run()
-        except KeyboardInterrupt:
-            print("Program terminated by user")
-            break
+            await run(session)
         except Exception as e:
-            print(f"Error while running: {e}")
+            log(f"Error while running: {e}\n")
             continue
 
 
+async def flush_periodically():
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL_SECONDS)
+        await asyncio.to_thread(flush_files)
+
+
+async def main_async():
+    # A service stop sends SIGTERM; cancel the workers so main() still flushes the cached files
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    async with aiohttp.ClientSession() as session:
+        try:
+            await asyncio.gather(flush_periodically(), *(run_repeatedly(session) for _ in range(NUM_TASKS)))
+        except asyncio.CancelledError:
+            log("Program terminated\n")
+
+
 def main():
     ensure_directory("times")
     ensure_directory("times_hourly")
     ensure_directory("first_bus_times")
     ensure_directory("last_bus_times")
-    num_threads = 4
-    with ThreadPoolExecutor(max_workers=num_threads) as executor:
-        futures = [executor.submit(run_repeatedly) for _ in range(num_threads)]
-        try:
-            for future in as_completed(futures):
-                future.result()
-        except KeyboardInterrupt:
-            print("Program terminated by user")
-            for future in futures:
-                future.cancel()
+    _log_thread.start()
+    try:
+        asyncio.run(main_async())
+    finally:
+        flush_files()
+        log(None)
+        _log_thread.join()
 
 
 if __name__ == '__main__':